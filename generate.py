@@ -1,13 +1,49 @@
-from collections import ChainMap
-from datetime import datetime
-import json
+import asyncio
+from calendar import monthrange
+from dataclasses import dataclass
+from functools import lru_cache
+import re
 import types
 
-import boto3
+import aioboto3
+from botocore.config import Config
+import orjson
 from satstac import Catalog as _Catalog, Item
 
 SOURCE_BUCKET_NAME = "radiant-nasa-iserv"
 TARGET_BUCKET_NAME = "iserv-stac"
+MAX_CONCURRENCY = 64
+MONTHS = (
+    "January",
+    "February",
+    "March",
+    "April",
+    "May",
+    "June",
+    "July",
+    "August",
+    "September",
+    "October",
+    "November",
+    "December",
+)
+
+# source JSON files other than catalogs and product metadata are items
+ITEM_KEY = re.compile(r"(?!.*(?:catalog|iserv|product)\.json\Z).*\.json\Z", re.DOTALL)
+
+# (asset name, title, media type) for list-style assets, keyed by file suffix
+ASSET_SUFFIXES = {
+    "TFW": ("original TIFF world file", "RGB GeoTIFF world file", "text/plain"),
+    "JPG": ("JPEG", "RGB JPEG", "image/jpeg"),
+    "png": ("thumbnail", "Thumbnail", "image/png"),
+    "JGW": ("JPEG world file", "JPEG world file", "text/plain"),
+    "JPG.ovr": ("JPEG overviews", "JPEG overviews", "image/tiff"),
+    "TIF": (
+        "visual",
+        "3-Band RGB GeoTIFF",
+        "image/vnd.stac.geotiff; cloud-optimized=true",
+    ),
+}
 
 
 class Catalog(_Catalog):
@@ -15,9 +51,104 @@ class Catalog(_Catalog):
         pass
 
 
-s3 = boto3.resource("s3")
-source_bucket = s3.Bucket(SOURCE_BUCKET_NAME)
-target_bucket = s3.Bucket(TARGET_BUCKET_NAME)
+@dataclass
+class Asset:
+    """A list-style asset; orjson serializes it like the equivalent dict."""
+
+    __slots__ = ("href", "title", "type")
+
+    href: str
+    title: str
+    type: str
+
+
+# the connection pool matches the number of requests allowed in flight, and
+# adaptive retries back off on SlowDown responses rather than failing the run
+S3_CONFIG = Config(
+    max_pool_connections=MAX_CONCURRENCY,
+    retries={"mode": "adaptive", "max_attempts": 10},
+)
+
+
+@lru_cache(maxsize=None)
+def describe(catalog_id):
+    """Format a YYYY[/MM[/DD]] catalog id as e.g. "March 7, 2013"."""
+    parts = catalog_id.split("/")
+    if len(parts) == 1:
+        return catalog_id
+
+    year, month = int(parts[0]), int(parts[1])
+    if not 1 <= month <= 12:
+        raise ValueError(catalog_id)
+    if len(parts) == 2:
+        return f"{MONTHS[month - 1]} {parts[0]}"
+
+    day = int(parts[2])
+    if not 1 <= day <= monthrange(year, month)[1]:
+        raise ValueError(catalog_id)
+    return f"{MONTHS[month - 1]} {day}, {parts[0]}"
+
+
+def links(**hrefs):
+    """Build a STAC links list from rel=href keyword arguments."""
+    return [{"rel": rel, "href": href} for rel, href in hrefs.items()]
+
+
+def without(asset, *keys):
+    """Copy an asset, leaving out the given keys."""
+    return {k: v for k, v in asset.items() if k not in keys}
+
+
+async def list_keys(s3_client, semaphore, prefix, delimiter=None):
+    """List item keys and common prefixes under a prefix of the source bucket."""
+    kwargs = {"Delimiter": delimiter} if delimiter is not None else {}
+    paginator = s3_client.get_paginator("list_objects_v2")
+
+    keys = []
+    prefixes = []
+    async with semaphore:
+        async for page in paginator.paginate(
+            Bucket=SOURCE_BUCKET_NAME,
+            Prefix=prefix,
+            PaginationConfig={"PageSize": 1000},
+            **kwargs,
+        ):
+            keys.extend(
+                obj["Key"]
+                for obj in page.get("Contents", [])
+                if ITEM_KEY.fullmatch(obj["Key"])
+            )
+            prefixes.extend(p["Prefix"] for p in page.get("CommonPrefixes", []))
+
+    return keys, prefixes
+
+
+async def list_pages(s3_client, semaphore):
+    """Yield lists of item keys from the source bucket.
+
+    Root-level keys come first, then the year-level keys of each year, then
+    each month (YYYY/MM/) in prefix order; months are listed concurrently.
+    Unfinished listings are cancelled when the generator is closed.
+    """
+    keys, years = await list_keys(s3_client, semaphore, "", delimiter="/")
+    yield keys
+
+    months = []
+    for year in years:
+        keys, year_months = await list_keys(s3_client, semaphore, year, delimiter="/")
+        yield keys
+        months.extend(year_months)
+
+    listings = [
+        asyncio.create_task(list_keys(s3_client, semaphore, month)) for month in months
+    ]
+    try:
+        for listing in listings:
+            keys, _ = await listing
+            yield keys
+    finally:
+        await cancel(listings)
+
 
 root_description = """
 # ISS SERVIR Environmental Research and Visualization System (ISERV) Level-0 Product
@@ -131,8 +262,7 @@ does not imply endorsement by the U.S. Government.
 """
 
 root_prefix = "https://iserv-stac.s3.amazonaws.com/0.6.1/"
-root_href = "{}catalog.json".format(root_prefix)
-root_catalog = Catalog.create(id="ISERV", description=root_description, version="1.0.0")
+root_href = f"{root_prefix}catalog.json"
 root_catalog = Catalog(
     {
         "id": "ISERV",
@@ -176,185 +306,140 @@ root_catalog = Catalog(
                 },
             ]
         },
+        "links": links(root=root_href, self=root_href),
     }
 )
-root_catalog.add_link("root", root_href)
-root_catalog.add_link("self", root_href)
 
 catalogs = {"root": root_catalog}
 
-for key in source_bucket.objects.all():
-    if (
-        not key.key.endswith(".json")
-        or key.key.endswith("catalog.json")
-        or key.key.endswith("iserv.json")
-        or key.key.endswith("product.json")
-    ):
-        continue
-
-    parents = []
-    path_components = key.key.split("/")[0:3]
-    for component in path_components:
-        catalog_id = "/".join(parents + [component])
+
+def get_catalog(key):
+    """Return the catalog that a source item belongs in.
+
+    Catalogs for the item's year, month and day are created (and linked to
+    their parents) as needed.
+    """
+    parent_id = "root"
+    for depth, component in enumerate(key.split("/")[0:3]):
+        catalog_id = component if depth == 0 else f"{parent_id}/{component}"
         catalog = catalogs.get(catalog_id)
 
         if catalog is None:
-            if len(parents) == 0:
-                parent = catalogs["root"]
-            else:
-                parent = catalogs["/".join(parents)]
-
-            if len(parents) == 0:
-                descriptive_timestamp = catalog_id
-            elif len(parents) == 1:
-                descriptive_timestamp = datetime.strptime(catalog_id, "%Y/%m").strftime(
-                    "%B %Y"
-                )
-            elif len(parents) == 2:
-                descriptive_timestamp = datetime.strptime(
-                    catalog_id, "%Y/%m/%d"
-                ).strftime("%B %-d, %Y")
-
-            catalog_href = "{}/catalog.json".format(component)
+            parent = catalogs[parent_id]
+
+            catalog_href = f"{component}/catalog.json"
             catalog = Catalog(
                 {
                     "id": catalog_id,
-                    "description": "Imagery from {}".format(descriptive_timestamp),
+                    "description": f"Imagery from {describe(catalog_id)}",
+                    "links": links(
+                        root=root_href, collection=root_href, parent="../catalog.json"
+                    ),
                 }
             )
-            catalog.add_link("root", root_href)
-            catalog.add_link("collection", root_href)
-            catalog.add_link("parent", "../catalog.json")
             parent.add_link("child", catalog_href)
 
             catalogs[catalog_id] = catalog
 
-        parents.append(component)
+        parent_id = catalog_id
+
+    return catalog
+
+
+def convert_item(key, body):
+    """Convert a source item to a 0.6.1 STAC item.
+
+    Returns (item id, target key, serialized item).
+    """
+    catalog_id = "/".join(key.split("/")[0:3])
 
     try:
-        obj = source_bucket.Object(key.key)
-        old_item = json.loads(obj.get()["Body"].read().decode("utf-8"))
+        old_item = orjson.loads(body)
 
         assets = old_item["assets"]
 
-        source_prefix = "https://{}.s3.amazonaws.com/{}".format(
-            SOURCE_BUCKET_NAME, "/".join(key.key.split("/")[0:-1])
-        )
+        source_dir = key.rpartition("/")[0]
+        source_prefix = f"https://{SOURCE_BUCKET_NAME}.s3.amazonaws.com/{source_dir}"
+
+        def source_href(href):
+            return f"{source_prefix}/{href}"
 
         new_assets = {}
 
         if type(assets) is dict:
             original_tiff = assets["RGB Tif"]
-            original_tiff["href"] = "{}/{}".format(source_prefix, original_tiff["href"])
-            original_tiff["title"] = "RGB GeoTIFF"
-            original_tiff["type"] = "image/vnd.stac.geotiff"
-            original_tiff["eo:bands"] = [0, 1, 2]
-            del original_tiff["name"]
-
-            new_assets["original TIFF"] = original_tiff
+            new_assets["original TIFF"] = {
+                **without(original_tiff, "name"),
+                "href": source_href(original_tiff["href"]),
+                "title": "RGB GeoTIFF",
+                "type": "image/vnd.stac.geotiff",
+                "eo:bands": [0, 1, 2],
+            }
 
             if "tiff world file" in assets:
                 original_tiff_world = assets["tiff world file"]
-                original_tiff_world["href"] = "{}/{}".format(
-                    source_prefix, original_tiff_world["href"]
-                )
-                original_tiff_world["title"] = "RGB GeoTIFF world file"
-                original_tiff_world[
-                    "type"
-                ] = (
-                    "text/plain"
-                )  # per https://www.loc.gov/preservation/digital/formats/fdd/fdd000287.shtml#sign
-                del original_tiff_world["name"]
-
-                new_assets["original TIFF world file"] = original_tiff_world
+                new_assets["original TIFF world file"] = {
+                    **without(original_tiff_world, "name"),
+                    "href": source_href(original_tiff_world["href"]),
+                    "title": "RGB GeoTIFF world file",
+                    # per https://www.loc.gov/preservation/digital/formats/fdd/fdd000287.shtml#sign
+                    "type": "text/plain",
+                }
 
             jpeg = assets["RGB JPEG"]
-            jpeg["href"] = "{}/{}".format(source_prefix, jpeg["href"])
-            jpeg["title"] = jpeg["name"]
-            jpeg["type"] = "image/jpeg"
-            del jpeg["name"]
-
-            new_assets["JPEG"] = jpeg
+            new_assets["JPEG"] = {
+                **without(jpeg, "name"),
+                "href": source_href(jpeg["href"]),
+                "title": jpeg["name"],
+                "type": "image/jpeg",
+            }
 
             jpeg_overviews = assets["jpg overview"]
-            jpeg_overviews["href"] = "{}/{}".format(
-                source_prefix, jpeg_overviews["href"]
-            )
-            jpeg_overviews["title"] = "JPEG overviews"
-            jpeg_overviews["type"] = "image/tiff"
-            del jpeg_overviews["name"]
-
-            new_assets["JPEG overviews"] = jpeg_overviews
+            new_assets["JPEG overviews"] = {
+                **without(jpeg_overviews, "name"),
+                "href": source_href(jpeg_overviews["href"]),
+                "title": "JPEG overviews",
+                "type": "image/tiff",
+            }
 
             jpeg_world = assets["jpeg world file"]
-            jpeg_world["href"] = "{}/{}".format(source_prefix, jpeg_world["href"])
-            jpeg_world["title"] = "JPEG world file"
-            jpeg_world["type"] = "text/plain"
-            del jpeg_world["name"]
-
-            new_assets["JPEG world file"] = jpeg_world
+            new_assets["JPEG world file"] = {
+                **without(jpeg_world, "name"),
+                "href": source_href(jpeg_world["href"]),
+                "title": "JPEG world file",
+                "type": "text/plain",
+            }
 
             thumbnail = assets["thumbnail"]
-            thumbnail["href"] = "{}/{}".format(source_prefix, thumbnail["href"])
-            thumbnail["title"] = "Thumbnail"
-            thumbnail["type"] = "image/png"
-            del thumbnail["name"]
-
-            new_assets["thumbnail"] = thumbnail
+            new_assets["thumbnail"] = {
+                **without(thumbnail, "name"),
+                "href": source_href(thumbnail["href"]),
+                "title": "Thumbnail",
+                "type": "image/png",
+            }
 
             visual = assets["cog"]
-            visual["href"] = "{}/{}".format(source_prefix, visual["href"])
-            visual["title"] = visual["name"]
-            visual["type"] = "image/vnd.stac.geotiff; cloud-optimized=true"
-            del visual["format"]
-            del visual["name"]
-
-            new_assets["visual"] = visual
+            new_assets["visual"] = {
+                **without(visual, "format", "name"),
+                "href": source_href(visual["href"]),
+                "title": visual["name"],
+                "type": "image/vnd.stac.geotiff; cloud-optimized=true",
+            }
 
         elif type(assets) is list:
             for asset in assets:
-                if asset["href"].endswith(".TFW"):
-                    new_assets["original TIFF world file"] = {
-                        "href": "{}/{}".format(source_prefix, asset["href"]),
-                        "title": "RGB GeoTIFF world file",
-                        "type": "text/plain",
-                    }
-
-                if asset["href"].endswith(".JPG"):
-                    new_assets["JPEG"] = {
-                        "href": "{}/{}".format(source_prefix, asset["href"]),
-                        "title": "RGB JPEG",
-                        "type": "image/jpeg",
-                    }
-
-                if asset["href"].endswith(".png"):
-                    new_assets["thumbnail"] = {
-                        "href": "{}/{}".format(source_prefix, asset["href"]),
-                        "title": "Thumbnail",
-                        "type": "image/png",
-                    }
-
-                if asset["href"].endswith(".JGW"):
-                    new_assets["JPEG world file"] = {
-                        "href": "{}/{}".format(source_prefix, asset["href"]),
-                        "title": "JPEG world file",
-                        "type": "text/plain",
-                    }
-
-                if asset["href"].endswith(".JPG.ovr"):
-                    new_assets["JPEG overviews"] = {
-                        "href": "{}/{}".format(source_prefix, asset["href"]),
-                        "title": "JPEG overviews",
-                        "type": "image/tiff",
-                    }
-
-                if asset["href"].endswith(".TIF"):
-                    new_assets["visual"] = {
-                        "href": "{}/{}".format(source_prefix, asset["href"]),
-                        "title": "3-Band RGB GeoTIFF",
-                        "type": "image/vnd.stac.geotiff; cloud-optimized=true",
-                    }
+                suffix = asset["href"].rpartition(".")[2]
+                if suffix == "ovr" and asset["href"].endswith(".JPG.ovr"):
+                    suffix = "JPG.ovr"
+
+                entry = ASSET_SUFFIXES.get(suffix)
+                if entry is not None:
+                    name, title, media_type = entry
+                    new_assets[name] = Asset(
+                        source_href(asset["href"]), title, media_type
+                    )
 
+        item_href = f"{old_item['id']}.json"
         item = Item(
             {
                 "type": "Feature",
@@ -367,35 +452,104 @@ for key in source_bucket.objects.all():
                     )
                 },
                 "assets": new_assets,
+                "links": links(
+                    root=root_href,
+                    parent="../catalog.json",
+                    self=f"{root_prefix}{catalog_id}/{item_href}",
+                ),
             }
         )
 
-        item_href = "{}.json".format(item.id)
-        item.add_link("root", root_href)
-        item.add_link("parent", "../catalog.json")
-        item.add_link("self", "{}{}/{}".format(root_prefix, catalog_id, item_href))
+        target_key = f"0.6.1/{catalog_id}/{item_href}"
+
+        return item.id, target_key, orjson.dumps(item.data)
+    except Exception as e:
+        print(f"{key}: {type(e).__name__}: {e}")
+        raise
+
+
+async def fetch_item(s3_client, semaphore, key):
+    """Fetch a source item and convert it with convert_item."""
+    async with semaphore:
+        response = await s3_client.get_object(Bucket=SOURCE_BUCKET_NAME, Key=key)
+        async with response["Body"] as stream:
+            body = await stream.read()
 
-        key = "0.6.1/{}/{}".format(catalog_id, item_href)
+    return convert_item(key, body)
 
+
+async def put_json(s3_client, semaphore, key, body):
+    """Upload a JSON document to the target bucket."""
+    async with semaphore:
         print(key)
-        obj = target_bucket.Object(key)
-        obj.put(Body=json.dumps(item.data), ContentType="application/json")
+        await s3_client.put_object(
+            Bucket=TARGET_BUCKET_NAME,
+            Key=key,
+            Body=body,
+            ContentType="application/json",
+        )
 
-        catalog.add_link("item", item_href, title=item.id)
-    except Exception as e:
-        print(key.key)
-        del old_item["geometry"]
-        print(json.dumps(old_item))
-        raise e
 
-for v in catalogs.values():
-    element = dict(ChainMap({}, {"stac_version": "0.6.1"}, v.data))
+def catalog_payload(v):
+    """Return the (key, body) to upload for a catalog."""
+    element = {**v.data, "stac_version": "0.6.1"}
 
     if v.id == "ISERV":
         key = "0.6.1/catalog.json"
     else:
-        key = "0.6.1/{}/catalog.json".format(element["id"].replace("ISERV", ""))
+        key = f"0.6.1/{element['id'].replace('ISERV', '')}/catalog.json"
+
+    return key, orjson.dumps(element)
+
+
+async def cancel(tasks):
+    """Cancel unfinished tasks and wait for them to wind down."""
+    pending = [task for task in tasks if not task.done()]
+    for task in pending:
+        task.cancel()
+
+    await asyncio.gather(*pending, return_exceptions=True)
+
+
+async def main():
+    semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async with aioboto3.Session().client("s3", config=S3_CONFIG) as s3_client:
+        # every request is tracked so that, if one fails, the rest can be
+        # cancelled before the client is closed underneath them
+        tasks = []
+        pages = list_pages(s3_client, semaphore)
+
+        try:
+            async for keys in pages:
+                fetches = [
+                    asyncio.create_task(fetch_item(s3_client, semaphore, key))
+                    for key in keys
+                ]
+                tasks.extend(fetches)
+                items = await asyncio.gather(*fetches)
+
+                for key, (item_id, target_key, body) in zip(keys, items):
+                    catalog = get_catalog(key)
+                    catalog.add_link("item", f"{item_id}.json", title=item_id)
+
+                    tasks.append(
+                        asyncio.create_task(
+                            put_json(s3_client, semaphore, target_key, body)
+                        )
+                    )
+
+            await asyncio.gather(*tasks)
+
+            payloads = [catalog_payload(v) for v in catalogs.values()]
+            tasks.extend(
+                asyncio.create_task(put_json(s3_client, semaphore, key, body))
+                for key, body in payloads
+            )
+            await asyncio.gather(*tasks)
+        finally:
+            await pages.aclose()
+            await cancel(tasks)
+
 
-    print(key)
-    obj = target_bucket.Object(key)
-    obj.put(Body=json.dumps(element), ContentType="application/json")
+asyncio.run(main())